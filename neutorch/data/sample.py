@@ -1,5 +1,6 @@
 from __future__ import annotations
 import os
+import math
 from abc import ABC, abstractmethod 
 import random
 from typing import List, Union
@@ -285,7 +286,7 @@ class Sample(AbstractSample):
     @cached_property
     def sampling_weight(self):
         """voxel number of label"""
-        weight = int(np.product(tuple(e-b for b, e in zip(
+        weight = int(math.prod(tuple(e-b for b, e in zip(
             self.center_start, self.center_stop))))
         
         # if len(np.unique(self.label)) == 1:
@@ -390,7 +391,7 @@ class SampleWithMask(Sample):
     def sampling_weight(self) -> int:
         block_num = len(self.candidate_block_bounding_boxes)
         block_size = self.label.block_size * self.voxel_size_factors
-        return np.product(block_size) * block_num
+        return math.prod(block_size) * block_num
 
     def __len__(self):
         # return int(1e100)
@@ -1,37 +1,87 @@
 import os
 import math
-import random
 from typing import Union
-from time import time, sleep
+from time import time
 
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import h5py
 
 from chunkflow.chunk import Chunk
+from chunkflow.lib.cartesian_coordinate import Cartesian
 
 import torch
 import toml
 
-from neutorch.data.sample import ReferenceVolume
+from neutorch.data.patch import Patch
 from neutorch.data.transform import *
 
 
+def read_dataset(dset: h5py.Dataset):
+    # read to a preallocated array directly to avoid an extra copy
+    img = np.empty(dset.shape, dtype=dset.dtype)
+    dset.read_direct(img)
+    return img
+
+
+def memmap_dataset(dset: h5py.Dataset):
+    """map a contiguous and uncompressed dataset to memory without reading it.
+    The patches sliced from it are served by the page cache of operating system.
+
+    Args:
+        dset (h5py.Dataset): the hdf5 dataset.
+
+    Returns:
+        img (np.memmap): the memory mapped volume. 
+            None if the dataset is chunked or compressed.
+    """
+    if dset.chunks is not None or dset.compression is not None:
+        return None
+    offset = dset.id.get_offset()
+    if offset is None:
+        # the storage is not allocated yet
+        return None
+    return np.memmap(dset.file.filename, dtype=dset.dtype, mode='r', 
+        offset=offset, shape=dset.shape)
+
+
 def image_reader(path: str):
     with h5py.File(path, 'r') as file:
-        img = np.asarray(file['main'])
+        img = read_dataset(file['main'])
     # the last one is affine transformation matrix in torchio image type
     return img, None
 
 
-class Dataset(torch.utils.data.Dataset):
+def volume_reader(path: str):
+    """map the volume to memory if possible, otherwise read it.
+    The file is only opened once.
+
+    Args:
+        path (str): the hdf5 file path.
+
+    Returns:
+        img (np.ndarray): the raw volume.
+    """
+    with h5py.File(path, 'r') as file:
+        dset = file['main']
+        img = memmap_dataset(dset)
+        if img is None:
+            img = read_dataset(dset)
+    return img
+
+
+class Dataset(torch.utils.data.IterableDataset):
     def __init__(self, config_file: str, 
             training_split_ratio: float = 0.9,
-            patch_size: Union[int, tuple]=(64, 64, 64)):
+            patch_size: Union[int, tuple]=(64, 64, 64),
+            batch_size: int = 1):
         """
         Parameters:
             config_file (str): file_path to provide metadata of all the ground truth data.
             training_split_ratio (float): split the datasets to training and validation sets.
             patch_size (int or tuple): the patch size we are going to provide.
+            batch_size (int): number of patches in a batch. 
+                The batch is assembled here, so use `batch_size=None` in DataLoader.
         """
         super().__init__()
         assert training_split_ratio > 0.5
@@ -46,10 +96,10 @@ class Dataset(torch.utils.data.Dataset):
             meta = toml.load(file)
         config_dir = os.path.dirname(config_file)
 
-        self._prepare_transform()
         assert isinstance(self.transform, Compose)
 
         self.patch_size = patch_size
+        self.batch_size = batch_size
         patch_size_before_transform = tuple(
             p + s0 + s1 for p, s0, s1 in zip(
                 patch_size, 
@@ -58,76 +108,172 @@ class Dataset(torch.utils.data.Dataset):
             )
         )
         
-        # load all the datasets
-        volumes = []
+        self.patch_size_before_transform = patch_size_before_transform
+        
+        # load all the datasets to memory
+        images = []
         for gt in meta.values():
             image_path = gt['image']
             assert image_path.endswith('.h5')
             image_path = os.path.join(config_dir, image_path)
 
-            image = Chunk.from_h5(image_path)
-            image = image.astype(np.float32) / 255.
-            reference_sample = ReferenceVolume(
-                image,
-                image,
-                patch_size=patch_size_before_transform,
-            )
-            volumes.append(reference_sample)
+            # keep the raw volume which is normalized patch by patch in transform
+            image = volume_reader(image_path)
+            # only uint8 volumes are normalized to 0-1 by NormalizeTo01
+            assert image.dtype == np.uint8, \
+                f'only support uint8 image volume, but got {image.dtype} in {image_path}'
+            # the batched sampling slides windows over exactly three axes
+            assert image.ndim == 3, \
+                f'only support 3D image volume, but got shape {image.shape} in {image_path}'
+            images.append(image)
         
         # shuffle the volume list and then split it to training and test
-        # random.shuffle(volumes)
-
-        # use the number of candidate patches as volume sampling weight
-        sample_weights = []
-        for volume in volumes:
-            sample_weights.append(volume.volume_sampling_weight)
-
-        self.training_sample_num = math.floor(len(volumes) * training_split_ratio)
-        self.validation_sample_num = len(volumes) - self.training_sample_num
-        self.training_samples = volumes[:self.training_sample_num]
-        self.validation_samples = volumes[-self.validation_sample_num:]
-        self.training_sample_weights = sample_weights[:self.training_sample_num]
-        self.validation_sample_weights = sample_weights[-self.validation_sample_num]
-        
-    @property
-    def random_training_patch(self):
+        # random.shuffle(images)
+
+        self.training_sample_num = math.floor(len(images) * training_split_ratio)
+        self.validation_sample_num = len(images) - self.training_sample_num
+        assert self.training_sample_num >= 1, \
+            f'no training volume from {len(images)} volumes with split ratio {training_split_ratio}.'
+        assert self.validation_sample_num >= 1, \
+            f'no validation volume from {len(images)} volumes with split ratio {training_split_ratio}.'
+
+        # keep the volumes and their properties in aligned arrays of each split
+        self._images = {
+            'training': images[:self.training_sample_num],
+            'validation': images[self.training_sample_num:],
+        }
+        # the image is also used as the reference, so we only keep one copy
+        self._labels = self._images
+        # the patch origin should be smaller than this stop
+        self._origin_stops = {}
+        # use the number of candidate patches as volume sampling probability
+        self._sample_probabilities = {}
+        for split, split_images in self._images.items():
+            origin_stops = np.asarray(
+                [image.shape[-3:] for image in split_images], dtype=np.int64
+            ) - np.asarray(patch_size_before_transform) + 1
+            assert np.all(origin_stops > 0), \
+                f'volume is smaller than patch size: {patch_size_before_transform}'
+            self._origin_stops[split] = origin_stops
+            sample_weights = np.prod(origin_stops, axis=1)
+            self._sample_probabilities[split] = sample_weights / sample_weights.sum()
+
+        self._rng = np.random.default_rng()
+
+    def _sample_patch(self, split: str) -> Patch:
+        origin_stops = self._origin_stops[split]
         # only sample one subject, so replacement option could be ignored
-        if self.training_sample_num == 1:
+        if len(origin_stops) == 1:
             sample_index = 0
         else:
-            sample_index = random.choices(
-                range(self.training_sample_num),
-                weights=self.training_sample_weights,
-                k=1,
-            )[0]
-        volume = self.training_samples[sample_index]
-        patch = volume.random_patch
+            sample_index = self._rng.choice(
+                len(origin_stops), p=self._sample_probabilities[split])
+        z, y, x = self._rng.integers(origin_stops[sample_index])
+        pz, py, px = self.patch_size_before_transform
+        # the image patch will be augmented in place, 
+        # so it should not be a view of our volume!
+        image = self._images[split][sample_index][..., z:z+pz, y:y+py, x:x+px].copy()
+        label = self._labels[split][sample_index][..., z:z+pz, y:y+py, x:x+px]
+        voxel_offset = Cartesian(z, y, x)
+        patch = Patch(
+            Chunk(image, voxel_offset=voxel_offset),
+            Chunk(label, voxel_offset=voxel_offset),
+        )
         self.transform(patch)
-        patch.apply_delayed_shrink_size()
-        print('patch shape: ', patch.shape)
+        return patch
+
+    def batched_patches(self, patch_num: int, split: str = 'training') -> Patch:
+        """sample a batch of random patches and transform them one by one
+
+        Args:
+            patch_num (int): number of patches in the batch.
+            split (str, optional): training or validation. Defaults to 'training'.
+
+        Returns:
+            Patch: image and label with a shape of (patch_num, 1, z, y, x)
+        """
+        origin_stops = self._origin_stops[split]
+        if len(origin_stops) == 1:
+            sample_indices = np.zeros((patch_num,), dtype=np.int64)
+        else:
+            sample_indices = self._rng.choice(
+                len(origin_stops), size=patch_num, 
+                p=self._sample_probabilities[split])
+
+        image_volumes = self._images[split]
+        label_volumes = self._labels[split]
+        batch_shape = (patch_num, 1, *self.patch_size_before_transform)
+        image = np.empty(batch_shape, dtype=image_volumes[0].dtype)
+        if label_volumes is not image_volumes:
+            label = np.empty(batch_shape, dtype=label_volumes[0].dtype)
+        for sample_index in np.unique(sample_indices):
+            selected = sample_indices == sample_index
+            zs, ys, xs = self._rng.integers(
+                origin_stops[sample_index], 
+                size=(np.count_nonzero(selected), 3)
+            ).T
+            # every window is a view of the volume. 
+            # the fancy indexing gathers the selected ones to a temporary array,
+            # which is then copied to the batch.
+            image[selected, 0] = sliding_window_view(
+                image_volumes[sample_index], 
+                self.patch_size_before_transform)[zs, ys, xs]
+            if label_volumes is not image_volumes:
+                label[selected, 0] = sliding_window_view(
+                    label_volumes[sample_index], 
+                    self.patch_size_before_transform)[zs, ys, xs]
+        
+        if label_volumes is image_volumes:
+            # the image is its own reference, no need to gather it again
+            label = image.copy()
+
+        # transform the patches one by one, so every patch gets its own 
+        # augmentation parameters, mask boxes and intensity guards.
+        image_batch = None
+        label_batch = None
+        for idx in range(patch_num):
+            patch = Patch(Chunk(image[idx:idx+1]), Chunk(label[idx:idx+1]))
+            self.transform(patch)
+            if image_batch is None:
+                image_batch = np.empty((patch_num, *patch.image.shape[1:]), 
+                    dtype=patch.image.dtype)
+                label_batch = np.empty((patch_num, *patch.label.shape[1:]), 
+                    dtype=patch.label.dtype)
+            image_batch[idx] = patch.image.array[0]
+            label_batch[idx] = patch.label.array[0]
+
+        patch = Patch(Chunk(image_batch), Chunk(label_batch))
+        return patch
+
+    @property
+    def random_training_patch(self):
+        patch = self._sample_patch('training')
         assert patch.shape[-3:] == self.patch_size, f'patch shape: {patch.shape}'
         return patch
 
     @property
     def random_validation_patch(self):
-        if self.validation_sample_num == 1:
-            sample_index = 0
-        else:
-            sample_index = random.choices(
-                range(self.validation_sample_num),
-                weights=self.validation_sample_weights,
-                k=1,
-            )[0]
-        volume = self.validation_samples[sample_index]
-        patch = volume.random_patch
-        self.transform(patch)
-        patch.apply_delayed_shrink_size()
-        return patch
+        return self._sample_patch('validation')
            
+    def __iter__(self):
+        """yield batches of random patches endlessly"""
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            # the forked workers inherit the same generator state,
+            # so every worker needs its own seed.
+            self._rng = np.random.default_rng(worker_info.seed)
+
+        while True:
+            patch = self.batched_patches(self.batch_size)
+            image = torch.from_numpy(patch.image.array)
+            label = torch.from_numpy(patch.label.array)
+            yield image, label
+
     @cached_property
     def transform(self):
         return Compose([
-            NormalizeTo01(),
+            # the reference is the image, so it needs to be normalized too
+            NormalizeTo01(normalize_label=True),
             AdjustBrightness(),
             AdjustContrast(),
             Gamma(),
@@ -140,38 +286,60 @@ class Dataset(torch.utils.data.Dataset):
 
 
 if __name__ == '__main__':
+    batch_size = 8
     dataset = Dataset(
         "~/Dropbox (Simons Foundation)/40_gt/tbar.toml",
-        max_sampling_distance=24,
         training_split_ratio=0.99,
+        batch_size=batch_size,
     )
 
     from torch.utils.tensorboard import SummaryWriter
     from neutorch.model.io import log_tensor
     writer = SummaryWriter(log_dir='/tmp/log')
 
-    import h5py
-    
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # the workers prefetch batches and the pinned batches 
+    # are copied to GPU asynchronously.
+    data_loader = torch.utils.data.DataLoader(
+        dataset,
+        # the batch is assembled in the dataset
+        batch_size=None,
+        num_workers=4,
+        pin_memory=torch.cuda.is_available(),
+        persistent_workers=True,
+        prefetch_factor=4,
+    )
+    data_iter = iter(data_loader)
+
+    # keep the debug files open and overwrite the datasets in place
+    debug_interval = 100
+    image_file = h5py.File('/tmp/image.h5', 'w', libver='latest')
+    target_file = h5py.File('/tmp/target.h5', 'w', libver='latest')
+    image_dset = image_file.create_dataset('main', 
+        shape=dataset.patch_size, dtype='f4', chunks=dataset.patch_size)
+    target_dset = target_file.create_dataset('main', 
+        shape=dataset.patch_size, dtype='f4', chunks=dataset.patch_size)
+
     model = torch.nn.Identity()
     print('start generating random patches...')
     for n in range(10000):
         ping = time()
-        patch = dataset.random_training_patch
-        print(f'generating a patch takes {round(time()-ping, 3)} seconds.')
-        image = patch.image
-        target = patch.target
-        with h5py.File('/tmp/image.h5', 'w') as file:
-            file['main'] = image[0,0, ...]
-        with h5py.File('/tmp/target.h5', 'w') as file:
-            file['main'] = target[0,0, ...]
-
-        assert np.any(target > 0)
-        print('number of nonzero voxels: ', np.count_nonzero(target))
+        image_batch, target_batch = next(data_iter)
+        print(f'generating a batch takes {round(time()-ping, 3)} seconds.')
+        image = image_batch.to(device, non_blocking=True)
+        target = target_batch.to(device, non_blocking=True)
+
+        if n % debug_interval == 0:
+            image_dset[...] = image_batch.numpy()[0,0, ...]
+            target_dset[...] = target_batch.numpy()[0,0, ...]
+            image_file.flush()
+            target_file.flush()
+
+        assert torch.any(target > 0)
+        print('number of nonzero voxels: ', torch.count_nonzero(target).item())
         # assert np.count_nonzero(tbar) == 8
-        image = torch.from_numpy(image)
-        target = torch.from_numpy(target)
-        log_tensor(writer, 'train/image', image, n)
-        log_tensor(writer, 'train/target', target, n)
+        log_tensor(writer, 'train/image', image, 'image', n)
+        log_tensor(writer, 'train/target', target, 'image', n)
 
         # # print(patch)
         # logits = model(image)
@@ -187,5 +355,6 @@ if __name__ == '__main__':
         #     normalize=True,
         #     scale_each=True,
         # )
-        sleep(1)
 
+    image_file.close()
+    target_file.close()
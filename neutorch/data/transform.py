@@ -15,6 +15,11 @@ try:
     from reneu.lib.segmentation import seg_to_affs, remove_contact_xy
 except ImportError:
     pass
+
+try:
+    import numba
+except ImportError:
+    numba = None
 # from copy import deepcopy
 
 
@@ -24,6 +29,51 @@ DEFAULT_PROBABILITY = .5
 DEFAULT_SHRINK_SIZE = (0, 0, 0, 0, 0, 0)
 # DEFAULT_SHRINK_SIZE = None
 
+# lookup table to normalize uint8 to float32 in 0-1
+UINT8_TO_01 = np.arange(256, dtype=np.float32) / np.float32(255.)
+
+
+if numba is not None:
+    # the DataLoader workers already run in parallel, 
+    # so the kernel only uses a single thread.
+    @numba.njit(fastmath=True, cache=True)
+    def _pointwise_kernel(arr, scale, shift, exponent):
+        for i in range(arr.shape[0]):
+            for j in range(arr.shape[1]):
+                v = min(max(arr[i, j] * scale + shift, 0.), 1.)
+                if exponent != 1.:
+                    v = v ** exponent
+                arr[i, j] = v
+
+
+def _pointwise_numpy(arr: np.ndarray, scale: float = 1., shift: float = 0.,
+        exponent: float = 1.):
+    if scale != 1.:
+        np.multiply(arr, scale, out=arr)
+    if shift != 0.:
+        np.add(arr, shift, out=arr)
+    np.clip(arr, 0., 1., out=arr)
+    if exponent != 1.:
+        np.power(arr, exponent, out=arr)
+
+
+def apply_pointwise(arr: np.ndarray, scale: float = 1., shift: float = 0., 
+        exponent: float = 1.):
+    """compute clip(arr * scale + shift, 0, 1) ** exponent in place.
+    The voxels are only visited once if numba is available.
+
+    Args:
+        arr (np.ndarray): image array normalized to 0-1.
+        scale (float, optional): contrast factor. Defaults to 1..
+        shift (float, optional): brightness. Defaults to 0..
+        exponent (float, optional): gamma exponent. Defaults to 1..
+    """
+    if numba is not None and arr.flags.c_contiguous:
+        _pointwise_kernel(arr.reshape(-1, arr.shape[-1]), 
+            scale, shift, exponent)
+    else:
+        _pointwise_numpy(arr, scale=scale, shift=shift, exponent=exponent)
+
 
 class AbstractTransform(ABC):
     def __init__(self, 
@@ -228,7 +278,8 @@ class MaskBox(IntensityTransform):
             if random.random() > 0.5:
                 box = np.random.rand(*box_size)
             else:
-                box = np.ones(box_size, dtype = patch.image.dtype) * random.random()
+                # a scalar is broadcasted without allocating a box
+                box = random.random()
             patch.image[
                 ...,
                 start[0] : start[0] + box_size[0],
@@ -247,14 +298,13 @@ class NormalizeTo01(IntensityTransform):
         return 'NormalizeTo01'
 
     def transform(self, patch: Patch):
+        # the table lookup casts and normalizes in a single pass
         if np.issubdtype(patch.image.dtype, np.uint8):
-            patch.image.array = patch.image.array.astype(np.float32)
-            patch.image.array = patch.image.array / 255.
+            patch.image.array = UINT8_TO_01.take(patch.image.array)
 
         if self.normalize_label and np.issubdtype(
                 patch.label.dtype, np.uint8) :
-            patch.label.array = patch.label.array.astype(np.float32)
-            patch.label.array = patch.label.array / 255.
+            patch.label.array = UINT8_TO_01.take(patch.label.array)
 
         return patch
 
@@ -271,8 +321,7 @@ class AdjustBrightness(IntensityTransform):
         brightness = random.uniform(-0.5, 0.5) * random.uniform(
             self.min_factor, self.max_factor)
         if patch.image.array.mean() + brightness < 0.9:
-            patch.image.array += brightness
-            np.clip(patch.image.array, 0., 1., out=patch.image.array)
+            apply_pointwise(patch.image.array, shift=brightness)
         return patch
 
 class AdjustContrast(IntensityTransform):
@@ -290,8 +339,7 @@ class AdjustContrast(IntensityTransform):
         #    self.factor_range[0], self.factor_range[1])
         factor = random.uniform(self.factor_range[0], self.factor_range[1])
         if np.mean(patch.image) * factor < 0.9:
-            patch.image *= factor
-            np.clip(patch.image.array, 0., 1., out=patch.image.array)
+            apply_pointwise(patch.image.array, scale=factor)
         return patch
 
 
@@ -305,7 +353,7 @@ class Gamma(IntensityTransform):
     def transform(self, patch: Patch):
         # gamma = random.random() * 2. - 1.
         gamma = random.uniform(-1., 1.)
-        patch.image **= 2.** gamma
+        apply_pointwise(patch.image.array, exponent=2.** gamma)
         return patch
 
 class GaussianBlur2D(IntensityTransform):
@@ -721,7 +769,7 @@ class Compose(object):
         Args:
             transforms (list): list of transform instances
         """
-        self.transforms = transforms
+        self.transforms = tuple(transforms)
 
     def __str__(self) -> str:
         return '-->'.join([str(x) for x in self.transforms])
@@ -742,9 +790,10 @@ class Compose(object):
         # after the transformation, the stride of array
         # could be negative, and pytorch could not tranform
         # the array to Tensor. Copy can fix it.
+        # The contiguous arrays are already fine and are not copied again.
         # print(f'patch shape after Compose call: {patch.shape}')
-        patch.image.array = patch.image.array.copy()
-        patch.label.array = patch.label.array.copy()
+        patch.image.array = np.ascontiguousarray(patch.image.array)
+        patch.label.array = np.ascontiguousarray(patch.label.array)
         if patch.has_mask:
-            patch.mask.array = patch.mask.array.copy()
+            patch.mask.array = np.ascontiguousarray(patch.mask.array)
 
@@ -1,4 +1,5 @@
 import os
+import math
 import random
 from abc import ABC, abstractproperty
 from functools import cached_property
@@ -116,6 +117,17 @@ class TrainerBase(ABC):
 
         return model
 
+    @cached_property
+    def mixed_precision(self) -> bool:
+        """run the forward pass in bfloat16 if the GPU supports it.
+        The model weights are still kept in float32.
+        It is off by default and could be turned on with 
+        `mixed_precision: true` in the train section.
+        """
+        if 'mixed_precision' not in self.cfg.train or not self.cfg.train.mixed_precision:
+            return False
+        return torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+
     @cached_property
     def optimizer(self):
         return torch.optim.Adam(
@@ -201,7 +213,7 @@ class TrainerBase(ABC):
 
     @cached_property
     def voxel_num(self):
-        return np.product(self.patch_size) * self.batch_size
+        return math.prod(self.patch_size) * self.batch_size
 
     def label_to_target(self, label: torch.Tensor):
         return label.cuda()
@@ -232,9 +244,11 @@ class TrainerBase(ABC):
             # print(f'preparing patch takes {round(time()-ping, 3)} seconds')
             # image.to(self.device)
             # self.model.to(self.device)
-            predict = self.model(image)
-            predict = self.post_processing(predict)
-            loss = self.loss_module(predict, target)
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16, 
+                    enabled=self.mixed_precision):
+                predict = self.model(image)
+                predict = self.post_processing(predict)
+                loss = self.loss_module(predict, target)
             self.optimizer.zero_grad()
             loss.backward()
             self.optimizer.step()
@@ -271,7 +285,8 @@ class TrainerBase(ABC):
                 validation_image, validation_label = next(iter(self.validation_data_iter))
                 validation_target = self.label_to_target(validation_label)
 
-                with torch.no_grad():
+                with torch.no_grad(), torch.autocast(device_type='cuda', 
+                        dtype=torch.bfloat16, enabled=self.mixed_precision):
                     validation_predict = self.model(validation_image)
                     validation_loss = self.loss_module(validation_predict, validation_target)
                     validation_predict = self.post_processing(validation_predict)
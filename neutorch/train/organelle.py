@@ -63,9 +63,11 @@ class OrganelleTrainer(SemanticTrainer):
 
             ping = time()
             # print(f'preparing patch takes {round(time()-ping, 3)} seconds')
-            predict = self.model(image)
-            # predict = self.post_processing(predict)
-            loss = self.loss_module(predict, label)
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16, 
+                    enabled=self.mixed_precision):
+                predict = self.model(image)
+                # predict = self.post_processing(predict)
+                loss = self.loss_module(predict, label)
             assert not torch.isnan(loss), 'loss is NaN.'
 
             self.optimizer.zero_grad()
@@ -95,7 +97,8 @@ class OrganelleTrainer(SemanticTrainer):
                 print('evaluate prediction: ')
                 validation_image, validation_label = next(self.validation_data_iter)
 
-                with torch.no_grad():
+                with torch.no_grad(), torch.autocast(device_type='cuda', 
+                        dtype=torch.bfloat16, enabled=self.mixed_precision):
                     validation_predict = self.model(validation_image)
                     validation_loss = self.loss_module(validation_predict, validation_label)
                     validation_predict = self.post_processing(validation_predict)
@@ -1,4 +1,5 @@
 import random
+import math
 import os
 from time import time
 from glob import glob
@@ -125,7 +126,7 @@ def main(config_file: str):
     )
     validation_data_iter = iter(validation_data_loader)
 
-    voxel_num = np.product(patch_size) * batch_size
+    voxel_num = math.prod(patch_size) * batch_size
     accumulated_loss = 0.
     iter_idx = cfg.train.iter_start
     for image, target in training_data_loader:
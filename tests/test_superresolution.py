@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import math
+import os
+
+import h5py
+import numpy as np
+
+from neutorch.data.superresolution import (
+    Dataset, memmap_dataset, read_dataset, volume_reader)
+
+
+def _volume():
+    return np.arange(4 * 5 * 6, dtype=np.uint8).reshape(4, 5, 6)
+
+
+def test_memmap_contiguous_dataset(tmp_path):
+    path = os.path.join(tmp_path, 'contiguous.h5')
+    with h5py.File(path, 'w') as file:
+        file.create_dataset('main', data=_volume())
+
+    with h5py.File(path, 'r') as file:
+        dset = file['main']
+        img = memmap_dataset(dset)
+        assert isinstance(img, np.memmap)
+        np.testing.assert_array_equal(img, read_dataset(dset))
+    np.testing.assert_array_equal(volume_reader(path), _volume())
+
+
+def test_memmap_chunked_dataset(tmp_path):
+    path = os.path.join(tmp_path, 'chunked.h5')
+    with h5py.File(path, 'w') as file:
+        file.create_dataset('main', data=_volume(), chunks=(2, 5, 6))
+
+    with h5py.File(path, 'r') as file:
+        assert memmap_dataset(file['main']) is None
+    # fall back to reading the volume
+    img = volume_reader(path)
+    assert not isinstance(img, np.memmap)
+    np.testing.assert_array_equal(img, _volume())
+
+
+def test_memmap_compressed_dataset(tmp_path):
+    path = os.path.join(tmp_path, 'compressed.h5')
+    with h5py.File(path, 'w') as file:
+        file.create_dataset('main', data=_volume(), compression='gzip')
+
+    with h5py.File(path, 'r') as file:
+        assert memmap_dataset(file['main']) is None
+    img = volume_reader(path)
+    assert not isinstance(img, np.memmap)
+    np.testing.assert_array_equal(img, _volume())
+
+
+def test_memmap_unallocated_dataset(tmp_path):
+    path = os.path.join(tmp_path, 'unallocated.h5')
+    with h5py.File(path, 'w') as file:
+        file.create_dataset('main', shape=(4, 5, 6), dtype=np.uint8)
+
+    with h5py.File(path, 'r') as file:
+        assert memmap_dataset(file['main']) is None
+
+
+def test_batched_patches_gather_windows(tmp_path):
+    shape = (4, 5, 6)
+    patch_size = (2, 3, 4)
+    # every voxel value is unique, so it locates the volume and the window origin
+    volumes = [
+        np.arange(math.prod(shape), dtype=np.uint8).reshape(shape),
+        np.arange(math.prod(shape), 2 * math.prod(shape), dtype=np.uint8).reshape(shape),
+        np.zeros(shape, dtype=np.uint8),
+    ]
+    config_file = os.path.join(tmp_path, 'config.toml')
+    with open(config_file, 'w') as file:
+        for idx, volume in enumerate(volumes):
+            with h5py.File(os.path.join(tmp_path, f'volume{idx}.h5'), 'w') as h5file:
+                h5file.create_dataset('main', data=volume)
+            file.write(f'[volume{idx}]\nimage = "volume{idx}.h5"\n')
+
+    dataset = Dataset(config_file, training_split_ratio=0.67, patch_size=patch_size)
+    assert len(dataset._images['training']) == 2
+    # check the gathered windows without augmentation
+    dataset.transform = lambda patch: patch
+    dataset._rng = np.random.default_rng(0)
+
+    patch_num = 16
+    patch = dataset.batched_patches(patch_num)
+    image = patch.image.array
+    label = patch.label.array
+    assert image.shape == (patch_num, 1, *patch_size)
+    assert label.shape == (patch_num, 1, *patch_size)
+    np.testing.assert_array_equal(label, image)
+    assert not np.shares_memory(label, image)
+
+    pz, py, px = patch_size
+    sample_indices = set()
+    for window in image[:, 0]:
+        sample_index, voxel_index = divmod(int(window[0, 0, 0]), math.prod(shape))
+        z, y, x = np.unravel_index(voxel_index, shape)
+        np.testing.assert_array_equal(
+            window, volumes[sample_index][z:z+pz, y:y+py, x:x+px])
+        sample_indices.add(sample_index)
+    # windows of both training volumes are gathered
+    assert sample_indices == {0, 1}
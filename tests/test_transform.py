@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from neutorch.data import transform
+
+
+@pytest.mark.parametrize('scale, shift, exponent', [
+    (1., 0., 1.),
+    (1.5, 0., 1.),
+    (1., 0.15, 1.),
+    (1., -0.2, 1.),
+    (1., 0., 0.5),
+    (0.8, 0.1, 2.),
+])
+def test_pointwise_kernel_matches_numpy(scale, shift, exponent):
+    if transform.numba is None:
+        pytest.skip('numba is not installed')
+
+    arr = np.random.rand(2, 1, 8, 16, 16).astype(np.float32)
+    expected = arr.copy()
+    transform._pointwise_numpy(expected,
+        scale=scale, shift=shift, exponent=exponent)
+
+    transform.apply_pointwise(arr,
+        scale=scale, shift=shift, exponent=exponent)
+
+    assert arr.dtype == np.float32
+    np.testing.assert_allclose(arr, expected, rtol=1e-5, atol=1e-6)